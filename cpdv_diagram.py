@@ -1,12 +1,17 @@
 #! /usr/bin/env python3
 
-import csv
 from argparse import ArgumentParser, ArgumentTypeError, FileType
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import numpy as np
 import os.path
 import sys
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None  # pandas is optional, see `load_deltas()`
+
 
 def ordinal_suffix(number):
     '''
@@ -23,35 +28,100 @@ def ordinal_suffix(number):
         return 'th'
 
 
-def gen_plot_points(tsv_file, markersize, show, verbose):
+def load_deltas(tsv_file):
+    '''
+    read the delay differences, i. e. the second column, from a .tsv file generated by cpdv_tsv.py
+
+    parameters:
+        - tsv_file: opened .tsv file or its filename
+    '''
+    if pd is not None:
+        # pandas' C tokenizer is considerably faster than np.loadtxt for large files
+        return pd.read_csv(tsv_file, sep='\t', header=None, usecols=[1], dtype=np.float64, engine='c').to_numpy().ravel()
+
+    # only parse the second column, ndmin=1 keeps files with a single line one-dimensional
+    return np.loadtxt(tsv_file, delimiter='\t', usecols=(1,), dtype=np.float64, ndmin=1)
+
+
+def decimate(deltas, max_points, envelope):
+    '''
+    reduce the data to at most max_points points for plotting, since far more points than pixels
+    only cost rendering time. returns a tuple of packet numbers and values
+
+    parameters:
+        - deltas: NumPy array with the data to plot
+        - max_points: number of points above which the data is reduced, 0 disables reducing, otherwise at least 3
+        - envelope: boolean that determines how the data is reduced. if False, every n-th value is kept, which
+          preserves the density of the point cloud. if True, the first, smallest and largest value of each n values
+          are kept, which preserves all spikes but overrepresents the extremes
+    '''
+    if max_points == 0 or len(deltas) <= max_points:
+        return np.arange(len(deltas)), deltas
+
+    if not envelope:
+        n = -(-len(deltas) // max_points)  # rounded up
+        return np.arange(0, len(deltas), n), deltas[::n]
+
+    # three points per group of n values, the last group may be smaller
+    n = -(-len(deltas) // (max_points // 3))  # rounded up
+    group_starts = np.arange(0, len(deltas), n)
+    group_count = len(deltas) // n
+    groups = deltas[:group_count * n].reshape(group_count, n)
+    group_minima = group_starts[:group_count] + groups.argmin(axis=1)
+    group_maxima = group_starts[:group_count] + groups.argmax(axis=1)
+    if group_count < len(group_starts):
+        tail = deltas[group_count * n:]
+        group_minima = np.append(group_minima, group_count * n + tail.argmin())
+        group_maxima = np.append(group_maxima, group_count * n + tail.argmax())
+    packet_numbers = np.concatenate((group_starts, group_minima, group_maxima))
+    packet_numbers = np.unique(packet_numbers)
+    return packet_numbers, deltas[packet_numbers]
+
+
+def points_line(markersize):
+    '''
+    create the figure for `gen_plot_points()` and return its (still empty) matplotlib line of points
+
+    parameters:
+        - markersize: float determining the size of the plotted points
+    '''
+    # constrained layout fits the labels while drawing, so saving needs no extra bbox_inches='tight' pass
+    _, ax = plt.subplots(constrained_layout=True)
+    line, = ax.plot([], [], '.', markersize=markersize)
+    ax.set_xlabel('Packet number')
+    ax.set_ylabel('Delta delay')
+    ax.set_title('Consecutive packet delay difference')
+    return line
+
+
+def gen_plot_points(tsv_file, line, max_points, envelope, show, verbose):
     '''
     generate a point plot from a .tsv file
 
     parameters:
         - tsv_file: opened .tsv file containing the data that will be plotted
-        - markersize: float determining the size of the plotted points
+        - line: line from `points_line()` that is used for plotting, it can be reused for several files
+        - max_points: maximum number of points to plot, see `decimate()`
+        - envelope: boolean that determines whether the data is reduced to its envelope, see `decimate()`
         - show: boolean that determines whether the plot will be shown (if show == True) or written to a file
         - verbose: boolean that determines whether information is written to stdout
     '''
     if verbose and not show:
         print(f'Plotting {tsv_file.name}... ', end='')
 
-    arrival_times = csv.reader(tsv_file, delimiter='\t')
-    # numpy needs something array-like, thus the conversion to a list
-    # also we only need the second column of every entry
-    deltas = np.array(list(arrival_times), dtype=float)[:, 1]
+    deltas = load_deltas(tsv_file)
 
-    plt.plot(np.arange(len(deltas)), deltas, '.', markersize=markersize)
-    plt.xlabel('Packet number')
-    plt.ylabel('Delta delay')
-    plt.title('Consecutive packet delay difference')
+    # replace the data of the existing line instead of creating new artists for every file
+    line.set_data(*decimate(deltas, max_points, envelope))
+    line.axes.relim()
+    line.axes.autoscale_view()
 
     if show:
         plt.show()
     else:
         extension_index = tsv_file.name.rfind(".")
         extension_index = len(tsv_file.name) if extension_index == -1 else extension_index
-        plt.savefig(f'{tsv_file.name[:extension_index]}.pdf', format='pdf', bbox_inches='tight')
+        line.figure.savefig(f'{tsv_file.name[:extension_index]}.pdf', format='pdf')
 
     if verbose and not show:
         print('done.')
@@ -73,37 +143,65 @@ def gen_plot_distribution(tsv_files_with_names, bin_size, percentile, limits, cl
     width = bin_size / (len(tsv_files_with_names) + 0)  # TODO: 1 or bin_size as numerator?
     deltas = [None for _ in range(len(tsv_files_with_names))]
 
+    # the files are independent of each other, so parse them in parallel if there are several files and
+    # CPUs. the workers get filenames because open files can't be passed to other processes, so stdin
+    # (`-t -`) is always read here
+    paths = [file.name for file, _ in tsv_files_with_names if file is not sys.stdin]
+    loaded = dict()
+    if len(paths) > 1 and (os.cpu_count() or 1) > 1:
+        with ProcessPoolExecutor() as pool:
+            loaded = dict(zip(paths, pool.map(load_deltas, paths)))
+
     for i, (file, _) in enumerate(tsv_files_with_names):
         if verbose:
             print(f'Generating distribution for {file.name}... ', end='')
             sys.stdout.flush()
 
-        arrival_times = csv.reader(file, delimiter='\t')
-        # numpy needs something array-like, thus the conversion to a list
-        # also we only need the second column of every entry
-        deltas[i] = np.array(list(arrival_times), dtype=float)[:, 1]
+        deltas[i] = loaded[file.name] if file.name in loaded else load_deltas(file)
+
+    # keep all data in one contiguous buffer, deltas[i] are views into it
+    all_deltas = np.concatenate(deltas)
+    offsets = np.cumsum([0] + [len(d) for d in deltas])
+    deltas = [all_deltas[offsets[i]:offsets[i + 1]] for i in range(len(deltas))]
 
     if limits is None:
-        bin_min = min(np.percentile(d, 100 - percentile) for d in deltas)
-        bin_max = max(np.percentile(d, percentile) for d in deltas)
+        # use the widest range of all files, both percentiles of a file are computed in one call
+        percentiles = np.array([np.percentile(d, [100 - percentile, percentile]) for d in deltas])
+        bin_min, bin_max = percentiles[:, 0].min(), percentiles[:, 1].max()
     else:
         bin_min, bin_max = limits
     
     if clip:
-        for i in range(len(deltas)):
-            deltas[i] = np.clip(deltas[i], bin_min, bin_max)
+        # in place, deltas[i] are views into all_deltas and no second copy of the data is needed
+        np.clip(all_deltas, bin_min, bin_max, out=all_deltas)
 
     # we need to add bin_size twice to the upper limit because
     # 1. we want the last bin to be [bin_max, bin_max + bin_size] and not [bin_max - bin_size, bin_max] for symmetry reasons
     # 2. np.arange excludes the upper limit but we want it to be included (adding any value larger than zero and less or equal to the step size,
     #    i. e. bin_size, would work)
     bins = np.arange(bin_min, bin_max + 2*bin_size, bin_size)
-    fig, ax = plt.subplots()
-
-    for i, d in enumerate(deltas):
-        histo, bin_edges = np.histogram(d, bins=bins)
-        histo = histo / np.sum(histo)  # calculate ratio, use np.sum(histo) instead of len(deltas) because we may have discarded some values
-        ax.bar(bin_edges[:-1] + width*i, histo, width, label=tsv_files_with_names[i][1])
+    fig, ax = plt.subplots(constrained_layout=True)  # see `points_line()`
+
+    # count all files at once in a (file, bin) matrix. the bins are uniform, so the bin of a value
+    # can be calculated directly instead of searching the bin edges like np.histogram does
+    file_numbers = np.repeat(np.arange(len(deltas)), np.diff(offsets))
+    in_range = (all_deltas >= bins[0]) & (all_deltas <= bins[-1])
+    values = all_deltas[in_range]
+    bin_count = len(bins) - 1
+    last_bin = bin_count - 1
+    bin_numbers = ((values - bin_min) / bin_size).astype(np.int64)
+    np.clip(bin_numbers, 0, last_bin, out=bin_numbers)
+    # fix values that rounding put next to their actual bin, like np.histogram does on its fast path
+    bin_numbers -= values < bins[bin_numbers]
+    bin_numbers += (values >= bins[bin_numbers + 1]) & (bin_numbers != last_bin)  # the last bin includes its upper edge
+    # np.bincount on the flattened (file, bin) index counts far faster than the unbuffered np.add.at
+    histos = np.bincount(file_numbers[in_range] * bin_count + bin_numbers, minlength=len(deltas) * bin_count)
+    histos = histos.reshape(len(deltas), bin_count).astype(np.float64)
+    histos /= np.sum(histos, axis=1, keepdims=True)  # calculate ratio, use the sum instead of len(d) because we may have discarded some values
+
+    bin_lefts = bins[:-1]
+    for i, histo in enumerate(histos):
+        ax.bar(bin_lefts + width*i, histo, width, label=tsv_files_with_names[i][1])
 
     if verbose:
         print('done.')
@@ -132,7 +230,7 @@ def gen_plot_distribution(tsv_files_with_names, bin_size, percentile, limits, cl
             print('Saving plot... ', end='')
             sys.stdout.flush()
         
-        fig.savefig('cpdv_dist.pdf', format='pdf', bbox_inches='tight')
+        fig.savefig('cpdv_dist.pdf', format='pdf')
 
         if verbose:
             print('done.')
@@ -147,8 +245,22 @@ def dir_checker(directory):
     return os.path.dirname(directory)  # this removes any trailing slashes which is nice for the plot legend
 
 
+def max_points_checker(value):
+    '''
+    argparse type checker for the maximum number of plotted points, which must be 0 or at least 3 (see `decimate()`)
+    '''
+    try:
+        max_points = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f'`{value}` is not an integer!')
+    if max_points != 0 and max_points < 3:
+        raise ArgumentTypeError(f'`{value}` must be 0 or at least 3!')
+    return max_points
+
+
 if __name__ == '__main__':
     DEFAULT_MARKER = 2.5
+    DEFAULT_MAXPOINTS = 50000
     DEFAULT_BINSIZE = 1
     DEFAULT_PERCENTILE = 100
     DEFAULT_FILENAME = 'cpdv_flow0.tsv'
@@ -165,6 +277,10 @@ if __name__ == '__main__':
     parser_points = subparsers.add_parser('points', help='plot the data points from each file separately')
     parser_points.add_argument('tsv_files', metavar='FILE', type=FileType('r'), nargs='+', help='a .tsv file to process')
     parser_points.add_argument('-m', '--marker', type=float, default=DEFAULT_MARKER, help=f'markersize passed to matplotlib, default {DEFAULT_MARKER}')
+    parser_points.add_argument('-n', '--maxpoints', type=max_points_checker, default=DEFAULT_MAXPOINTS, help=f'reduce files with more data points to at most this many points \
+        by plotting only every n-th point, 0 plots all points, otherwise at least 3, default {DEFAULT_MAXPOINTS}')
+    parser_points.add_argument('-e', '--envelope', action='store_true', help='when reducing the points (see -n), keep the first, smallest and largest \
+        value of each group of points instead of every n-th point. this shows all spikes but overrepresents the extreme values')
     parser_points.add_argument('-s', '--show', action='store_true', help='show the diagram(s) instead of writing them to a file')
     parser_points.add_argument('-v', '--verbose', dest='verbose_points', action='store_true', help=VERBOSE_HELP)
 
@@ -190,8 +306,12 @@ if __name__ == '__main__':
     args = parser.parse_args(sys.argv[1:])  # don't pass script name to argparser
 
     if args.mode == 'points':
+        line = None
         for tsv in args.tsv_files:
-            gen_plot_points(tsv, args.marker, args.show, args.verbose or args.verbose_points)
+            # all files share one figure, except when showing them because closing the window discards the figure
+            if line is None or args.show:
+                line = points_line(args.marker)
+            gen_plot_points(tsv, line, args.maxpoints, args.envelope, args.show, args.verbose or args.verbose_points)
     elif args.mode == 'distribution':
         if args.tsv is not None:
             tsv_files_with_names = [(f, f.name[:-4]) for f in args.tsv]
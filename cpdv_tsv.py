@@ -1,8 +1,12 @@
 #! /usr/bin/env python3
 
 from argparse import ArgumentParser
+from array import array
+from collections import defaultdict
+from itertools import chain
+import numpy as np
 import os.path
-from scapy.utils import rdpcap
+from scapy.utils import PcapReader
 from scapy.layers.inet import IP, TCP, UDP
 from scapy.packet import Raw
 import sys
@@ -21,30 +25,75 @@ ABOUT THIS SCRIPT:
 
 def get_flow_id(packet):
     '''
-    get a string that uniquely identifies one flow, i. e. a connection between
+    get a tuple (src, sport, dst, dport) that uniquely identifies one flow, i. e. a connection between
     to IP addresses respecting ports and direction, for a given packet.
     example: one flow is from 1.0.0.1:1234 to 11.0.0.2:500, another one is from 11.0.0.2:500 to
     1.0.0.1:1234 and a third one is from 2.0.0.1:4321 to 11.0.0.2:600
     '''
-    return f'{packet[IP].src}:{packet[IP].sport}->{packet[IP].dst}:{packet[IP].dport}'
+    # a tuple is cheaper to build than a formatted string, see `format_flow_id()` for printing it.
+    # look up the IP layer only once, every lookup walks through the packet's layers
+    ip = packet[IP]
+    return (ip.src, ip.sport, ip.dst, ip.dport)
 
 
-def get_data_tcp(packets):
+def format_flow_id(flow_id):
+    '''
+    get a human readable string like 1.0.0.1:1234->11.0.0.2:500 for a flow id from `get_flow_id()`
+    '''
+    return '{}:{}->{}:{}'.format(*flow_id)
+
+
+def group_by_flow(flow_ids, flows, seqs, times):
     '''
-    get a dictionary that contains for each found flow a dictionary that maps sequence number
-    to arrival time in milliseconds
+    get a dictionary that maps each flow id to a tuple of two NumPy arrays: the sequence numbers
+    of the flow in ascending order and the corresponding arrival times
 
     parameters:
-        - packets: list of TCP packets
+        - flow_ids: list of flow ids (see `get_flow_id()`), the position in this list is the flow's number
+        - flows: array('q') containing the flow number of each packet
+        - seqs: array('q') containing the sequence number of each packet
+        - times: array('q') containing the arrival time of each packet
     '''
-    # this is a layered dict. the first key maps a flow (see `get_flow_id()`) to its
-    # sequences dict. the key for this sequences dict maps the sequence number to the
-    # arrival time of the packet with that sequence number
+    # view the buffers as NumPy arrays without copying them
+    flows = np.frombuffer(flows, dtype=np.int64)
+    seqs = np.frombuffer(seqs, dtype=np.int64)
+    times = np.frombuffer(times, dtype=np.int64)
+    if len(flows) == 0:
+        return dict()
+
+    # sort by flow number first and by sequence number second. lexsort is stable, so packets
+    # with the same sequence number stay in the order in which they arrived
+    order = np.lexsort((seqs, flows))
+    sorted_flows, sorted_seqs = flows[order], seqs[order]
+
     # NOTE: this discards all but the last packet for a given sequence number, e. g.
     # if the packets sent are only ACKs and the sequence number doens't change
-    seq_to_arrival_time = dict()
-    # has there been at least one packet with payload len > 0 in the flow?
-    data_sent = dict()
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (sorted_flows[1:] != sorted_flows[:-1]) | (sorted_seqs[1:] != sorted_seqs[:-1])
+    # gather every field only once, straight from the unsorted data
+    keep = order[last]
+    flows, seqs, times = flows[keep], seqs[keep], times[keep]
+
+    # flow numbers are assigned in order of appearance, so the resulting dict keeps that order
+    flow_starts = np.flatnonzero(np.diff(flows)) + 1
+    flow_numbers = flows[np.concatenate(([0], flow_starts))]
+    return {flow_ids[n]: (s, t) for n, s, t in zip(flow_numbers, np.split(seqs, flow_starts), np.split(times, flow_starts))}
+
+
+def get_data_tcp(packets):
+    '''
+    get a dictionary that contains for each found flow a tuple of its sequence numbers and the
+    arrival times in nanoseconds, see `group_by_flow()`
+
+    parameters:
+        - packets: iterable of TCP packets
+    '''
+    # maps a flow (see `get_flow_id()`) to its flow number
+    flow_numbers = dict()
+    # has there been at least one packet with payload len > 0 in the flow? indexed by flow number
+    data_sent = defaultdict(bool)
+    # flow number, sequence number and arrival time of every packet, one array per field
+    flows, seqs, times = array('q'), array('q'), array('q')
 
     for pkt in packets:
         seq_number = pkt[TCP].seq
@@ -53,18 +102,21 @@ def get_data_tcp(packets):
 
         flow_id = get_flow_id(pkt)
 
-        if flow_id not in seq_to_arrival_time:
-            seq_to_arrival_time[flow_id] = dict()
-            data_sent[flow_id] = False
-
-        seq_to_arrival_time[flow_id][seq_number] = pkt.time * 1000
+        # new flows get the next free number, with a single dict lookup for known ones
+        flow_number = flow_numbers.setdefault(flow_id, len(flow_numbers))
+        flows.append(flow_number)
+        seqs.append(seq_number)
+        # integer nanoseconds keep the full precision of the capture, unlike float milliseconds
+        times.append(int(pkt.time * 1_000_000_000))
 
         if pkt.haslayer(Raw):
-            data_sent[flow_id] = True
+            data_sent[flow_number] = True
+
+    seq_to_arrival_time = group_by_flow(list(flow_numbers), flows, seqs, times)
 
     # ignore flows where no data was sent
-    for flow in data_sent:
-        if not data_sent[flow]:
+    for flow, flow_number in flow_numbers.items():
+        if not data_sent[flow_number]:
             del seq_to_arrival_time[flow]
 
     return seq_to_arrival_time
@@ -72,16 +124,16 @@ def get_data_tcp(packets):
 
 def get_data_iperfudp(packets):
     '''
-    get a dictionary that contains for each found flow a dictionary that maps sequence number
-    to arrival time in milliseconds
+    get a dictionary that contains for each found flow a tuple of its sequence numbers and the
+    arrival times in nanoseconds, see `group_by_flow()`
 
     parameters:
-        - packets: list of UDP packets
+        - packets: iterable of UDP packets
     '''
-    # this is a layered dict. the first key maps a flow (see `get_flow_id()`) to its
-    # sequences dict. the key for this sequences dict maps the sequence number to the
-    # arrival time of the packet with that sequence number
-    seq_to_arrival_time = dict()
+    # see `get_data_tcp()` for what these are
+    flow_numbers = dict()
+    flows, seqs, times = array('q'), array('q'), array('q')
+
     for pkt in packets:
         # UDP normally doesn't have sequence numbers, but iperf uses the first four
         # bytes of the payload to store a sequence number
@@ -93,12 +145,12 @@ def get_data_iperfudp(packets):
 
         flow_id = get_flow_id(pkt)
 
-        if flow_id not in seq_to_arrival_time:
-            seq_to_arrival_time[flow_id] = dict()
+        flows.append(flow_numbers.setdefault(flow_id, len(flow_numbers)))
+        seqs.append(seq_number)
+        # integer nanoseconds keep the full precision of the capture, unlike float milliseconds
+        times.append(int(pkt.time * 1_000_000_000))
 
-        seq_to_arrival_time[flow_id][seq_number] = pkt.time * 1000
-
-    return seq_to_arrival_time
+    return group_by_flow(list(flow_numbers), flows, seqs, times)
 
 
 def write_tsv(pcap_filename, mode, verbose):
@@ -114,51 +166,47 @@ def write_tsv(pcap_filename, mode, verbose):
     if verbose:
         print(f'Reading {pcap_filename}... ', end='')
         sys.stdout.flush()  # seems to be necessary here
-    packets = rdpcap(pcap_filename)
-
-    if mode == 'udp':
-        get_data = get_data_iperfudp
-    elif mode =='tcp':
-        get_data = get_data_tcp
-    elif mode =='auto':
-        if packets[0].haslayer(UDP):
+    # read the packets lazily instead of loading the whole capture into memory
+    with PcapReader(pcap_filename) as packets:
+        if mode == 'udp':
             get_data = get_data_iperfudp
-        elif packets[0].haslayer(TCP):
+        elif mode =='tcp':
             get_data = get_data_tcp
-        else:
-            raise ValueError('First package is neither UDP nor TCP!')
-
-    # maps the sequence number to the arrival time, see `get_data_tcp()` for more details
-    seq_to_arrival_time = get_data(packets)
+        elif mode =='auto':
+            first_packet = next(packets, None)
+            if first_packet is None:
+                raise ValueError(f'{pcap_filename} contains no packets!')
+            elif first_packet.haslayer(UDP):
+                get_data = get_data_iperfudp
+            elif first_packet.haslayer(TCP):
+                get_data = get_data_tcp
+            else:
+                raise ValueError('First package is neither UDP nor TCP!')
+            # put the first packet back in front of the remaining ones
+            packets = chain([first_packet], packets)
+
+        # maps each flow to its sequence numbers and arrival times, see `group_by_flow()` for more details
+        seq_to_arrival_time = get_data(packets)
 
     if verbose:
         print(f'found the following flows:')
-    for flow_number, flow in enumerate(seq_to_arrival_time):
-        cur_arrival_times = seq_to_arrival_time[flow]
+    for flow_number, (flow, (seqs, times)) in enumerate(seq_to_arrival_time.items()):
         # we need at least two packets for calculating deltas
-        if len(cur_arrival_times) < 2:
+        if len(seqs) < 2:
             continue
 
         if verbose:
-            print(f'\t{flow_number}: {flow} - {len(seq_to_arrival_time[flow])} packets')
+            print(f'\t{flow_number}: {format_flow_id(flow)} - {len(seqs)} packets')
 
-        # sort by sequence number
-        cur_arrival_times = dict(sorted(cur_arrival_times.items(), key=lambda item: item[0]))
-        prev_time = None
+        # the first packet has no predecessor, so it gets no delta. convert to milliseconds
+        # only after subtracting, the integer difference is exact
+        deltas = np.diff(times) * 1e-6
 
         # extension_index = pcap_filename.rfind(".")
         # extension_index = len(pcap_filename) if extension_index == -1 else extension_index
         # tsv_filename = f'{pcap_filename[:extension_index]}_{flow_number}.tsv'
         tsv_filename = os.path.join(os.path.dirname(pcap_filename), f'cpdv_flow{flow_number}.tsv')
-        with open(tsv_filename, 'w') as f:
-            for seq_nr in cur_arrival_times:
-                if prev_time is None:
-                    prev_time = cur_arrival_times[seq_nr]
-                    continue
-
-                delta = cur_arrival_times[seq_nr] - prev_time
-                f.write(f'{seq_nr}\t{delta}\n')
-                prev_time = cur_arrival_times[seq_nr]
+        np.savetxt(tsv_filename, np.column_stack((seqs[1:], deltas)), fmt='%d\t%.6f')
 
 
 if __name__ == '__main__':